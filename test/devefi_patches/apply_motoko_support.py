@@ -3,60 +3,146 @@
 Apply patches to common.ts for Motoko ICRC_fungible ledger support.
 This script modifies the devefi_ledger_tests to support the PanIndustrial Motoko token.
 """
-import re
 import sys
+from collections import namedtuple
+from pathlib import Path
 
 DEVEFI_DIR = '/tmp/devefi_ledger_tests'
 COMMON_TS_PATH = f'{DEVEFI_DIR}/common.ts'
 
+# Text each patch leaves behind. Each string only
+# occurs once in a patched file, so the file-wide fast-path check agrees with the local ones.
+SENTINELS = {
+    'import': "from './icrc_ledger/motoko_ledger.idl.js'",
+    'ledger_impl': 'export const LEDGER_IMPL',
+    'wasm': 'let MOTOKO_WASM_PATH',
+    'get_motoko_args': 'function get_motoko_args',
+    'icrc_ledger': 'get_motoko_args(me)',
+    'upgrade': 'motokoInit({ IDL }), [[]]',
+}
+# The file is fully patched when every sentinel is present
+PATCHED_MARKERS = tuple(sentinel.encode() for sentinel in SENTINELS.values())
+
+# One edit to common.ts: `locate` returns the (start, end) span to replace, or None,
+# and applied/present/missing are the messages printed for each outcome. The sentinel is
+# looked for in the whole file, or only inside the located span when `in_span` is set.
+Patch = namedtuple('Patch', 'sentinel locate replacement applied present missing in_span',
+                   defaults=(False,))
+
+def _after(content, *landmarks, start=0):
+    """Return the offset just past the last of `landmarks`, found in order, or -1."""
+    pos = start
+    for landmark in landmarks:
+        pos = content.find(landmark, pos)
+        if pos == -1:
+            return -1
+        pos += len(landmark)
+    return pos
+
+def _closing_brace(content, pos):
+    """Return the offset just past the `}` matching the first `{` at or after `pos`, or -1."""
+    open_at = content.find('{', pos)
+    if open_at == -1:
+        return -1
+    depth = 0
+    for i in range(open_at, len(content)):
+        if content[i] == '{':
+            depth += 1
+        elif content[i] == '}':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return -1
+
+def _span(content, anchor, *landmarks):
+    """Return (start, end) of the braced block that follows `anchor` and `landmarks`, or None."""
+    start = content.find(anchor)
+    if start == -1:
+        return None
+    pos = _after(content, *landmarks, start=start)
+    end = -1 if pos == -1 else _closing_brace(content, pos)
+    return None if end == -1 else (start, end)
+
+def _import_end(content):
+    i = _after(content, 'ICPLedgerService', "from './icp_ledger/ledger.idl'")
+    if i == -1:
+        return None
+    if content.startswith(';', i):
+        i += 1
+    return (i, i)
+
+def _ledger_type_end(content):
+    i = _after(content, 'export const LEDGER_TYPE', ';')
+    return None if i == -1 else (i, i)
+
+def _wasm_block(content):
+    begin = content.find('let ICRC_WASM_PATH')
+    if begin == -1:
+        return None
+    # The motoko `if` must sit among the WASM path declarations, before the next one or definition
+    stops = [content.find(stop, begin) for stop in ('let ICP_WASM_PATH', '\nfunction', '\nexport')]
+    limit = min((i for i in stops if i != -1), default=len(content))
+    for guard in ('if (process.env[\'LEDGER\'] === "motoko")', 'if (LEDGER_IMPL === "motoko")'):
+        i = content.find(guard, begin, limit)
+        if i != -1:
+            end = _closing_brace(content, i)
+            return (begin, end) if end != -1 and end <= limit else None
+    return None
+
+def _get_args_end(content):
+    i = _after(content, 'function get_args(me: Principal)', 'return ledger_args;', '}')
+    return None if i == -1 else (i, i)
+
+def _icrc_ledger_function(content):
+    span = _span(content, 'export async function ICRCLedger(')
+    if span is None:
+        return None
+    start, end = span
+    return (start, end + 1) if content.startswith(';', end) else span
+
+def _upgrade_function(content):
+    return _span(content, 'export async function ICRCLedgerUpgrade(')
+
+def _splice(content, edits):
+    """Apply non-overlapping (start, end, replacement) edits in a single pass."""
+    out = []
+    prev = 0
+    for start, end, replacement in sorted(edits):
+        out.append(content[prev:start])
+        out.append(replacement)
+        prev = end
+    out.append(content[prev:])
+    return ''.join(out)
+
 def main():
     # Read the file
     try:
-        with open(COMMON_TS_PATH, 'r') as f:
-            content = f.read()
+        data = Path(COMMON_TS_PATH).read_bytes()
     except FileNotFoundError:
         print(f"Error: {COMMON_TS_PATH} not found. Make sure devefi_ledger_tests is cloned.")
         sys.exit(1)
 
+    # Fast path: leave an already patched file (and its mtime) untouched
+    if all(marker in data for marker in PATCHED_MARKERS):
+        print("○ common.ts is already fully patched")
+        return 0
+
+    # Normalise line endings like text-mode reads do, so inserted snippets match the file
+    content = data.decode('utf-8').replace('\r\n', '\n')
+
     original_length = len(content)
-    patches_applied = 0
 
     # 1. Add Motoko import after ICP ledger import
-    import_pattern = r"(import \{ _SERVICE as ICPLedgerService.*?from ['\"]\.\/icp_ledger\/ledger\.idl['\"];?)"
-    import_replacement = r"""\1
+    motoko_import = """
 // Motoko ICRC_fungible ledger support
 import { idlFactory as MotokoLedgerIdlFactory, init as motokoInit } from './icrc_ledger/motoko_ledger.idl.js';"""
-    
-    if re.search(import_pattern, content, re.DOTALL):
-        if 'MotokoLedgerIdlFactory' not in content:
-            content = re.sub(import_pattern, import_replacement, content, flags=re.DOTALL)
-            patches_applied += 1
-            print("✓ Added Motoko import statement")
-        else:
-            print("○ Motoko import already present")
-    else:
-        print("✗ Could not find ICPLedgerService import pattern")
 
     # 2. Add LEDGER_IMPL after LEDGER_TYPE export
-    ledger_type_pattern = r'(export const LEDGER_TYPE\s*=\s*process\.env\[[\'"]LEDGER_TYPE[\'"]\]\s*as\s*["\']icrc["\'].*?;)'
     ledger_impl_code = """
 // Support for multiple ledger implementations: "dfinity" (default) or "motoko"
 export const LEDGER_IMPL = process.env['LEDGER'] as "dfinity" | "motoko" | undefined;"""
 
-    if re.search(ledger_type_pattern, content, re.DOTALL):
-        if 'LEDGER_IMPL' not in content:
-            content = re.sub(ledger_type_pattern, r'\1' + ledger_impl_code, content, flags=re.DOTALL)
-            patches_applied += 1
-            print("✓ Added LEDGER_IMPL export")
-        else:
-            print("○ LEDGER_IMPL already present")
-    else:
-        print("✗ Could not find LEDGER_TYPE export pattern")
-
     # 3. Update WASM path section to use gzipped WASM for Motoko
-    # Look for the existing motoko WASM path setup
-    wasm_pattern = r'let ICRC_WASM_PATH\s*=\s*resolve\(__dirname,\s*["\']\.\/icrc_ledger\/ledger\.wasm["\']\);[\s\S]*?if\s*\(process\.env\[[\'"]LEDGER[\'"]\]\s*===\s*["\']motoko["\']\)\s*\{[\s\S]*?ICRC_WASM_PATH\s*=\s*resolve\(__dirname,\s*["\']\.\/icrc_ledger\/motoko_ledger\.wasm["\']\);[\s\S]*?\}'
-    
     wasm_new = '''let ICRC_WASM_PATH = resolve(__dirname, "./icrc_ledger/ledger.wasm");
 let MOTOKO_WASM_PATH = resolve(__dirname, "./icrc_ledger/motoko_ledger.wasm.gz");
 
@@ -64,16 +150,6 @@ if (LEDGER_IMPL === "motoko") {
     console.log("🚀🦀 USING MOTOKO LEDGER - BRACE FOR IMPACT! 💥🦑");
 }'''
 
-    if re.search(wasm_pattern, content, re.DOTALL):
-        if 'MOTOKO_WASM_PATH' not in content:
-            content = re.sub(wasm_pattern, wasm_new, content, flags=re.DOTALL)
-            patches_applied += 1
-            print("✓ Updated WASM path section to use .wasm.gz")
-        else:
-            print("○ MOTOKO_WASM_PATH already present")
-    else:
-        print("✗ Could not find WASM path pattern")
-
     # 4. Add get_motoko_args function after get_args function
     get_motoko_args_fn = '''
 
@@ -134,22 +210,7 @@ function get_motoko_args(me: Principal): any {
     return initArgs;
 }'''
 
-    # Find the end of get_args function and add get_motoko_args after it
-    get_args_pattern = r'(function get_args\(me:\s*Principal\)[\s\S]*?return ledger_args;\s*\})'
-    
-    if re.search(get_args_pattern, content):
-        if 'get_motoko_args' not in content:
-            content = re.sub(get_args_pattern, r'\1' + get_motoko_args_fn, content)
-            patches_applied += 1
-            print("✓ Added get_motoko_args function")
-        else:
-            print("○ get_motoko_args already present")
-    else:
-        print("✗ Could not find get_args function pattern")
-
     # 5. Replace ICRCLedger function to support Motoko
-    icrc_ledger_pattern = r'export async function ICRCLedger\(pic:\s*PocketIc,\s*me:\s*Principal,\s*subnet:\s*Principal\s*\|\s*undefined\)\s*\{[\s\S]*?const fixture = await pic\.setupCanister<ICRCLedgerService>\(\{[\s\S]*?idlFactory:\s*ICRCLedgerIdlFactory,[\s\S]*?wasm:\s*ICRC_WASM_PATH,[\s\S]*?arg:\s*IDL\.encode\(icrcInit\(\{IDL\}\),\s*\[get_args\(me\)\]\),[\s\S]*?\}\);[\s\S]*?await pic\.addCycles[\s\S]*?return \{[\s\S]*?canisterId:.*?fixture\.canisterId,[\s\S]*?actor:.*?fixture\.actor.*?ICRCLedgerService>[\s\S]*?\};[\s\S]*?\};'
-    
     new_icrc_ledger = '''export async function ICRCLedger(pic: PocketIc, me:Principal, subnet:Principal | undefined) {
     // Use Motoko ICRC_fungible ledger with its own init format
     if (LEDGER_IMPL === "motoko") {
@@ -186,19 +247,7 @@ function get_motoko_args(me: Principal): any {
     };
 };'''
 
-    if re.search(icrc_ledger_pattern, content):
-        if 'LEDGER_IMPL === "motoko"' not in content:
-            content = re.sub(icrc_ledger_pattern, new_icrc_ledger, content)
-            patches_applied += 1
-            print("✓ Updated ICRCLedger function")
-        else:
-            print("○ ICRCLedger already patched")
-    else:
-        print("✗ Could not find ICRCLedger function pattern")
-
     # 6. Update ICRCLedgerUpgrade
-    upgrade_pattern = r'export async function ICRCLedgerUpgrade\(pic:\s*PocketIc,\s*me:\s*Principal,\s*canister_id:\s*Principal,\s*subnet:\s*Principal\s*\|\s*undefined\)\s*\{[\s\S]*?await pic\.upgradeCanister\(\{[\s\S]*?canisterId:\s*canister_id,[\s\S]*?wasm:\s*ICRC_WASM_PATH,[\s\S]*?\}\);[\s\S]*?\}'
-    
     new_upgrade = '''export async function ICRCLedgerUpgrade(pic: PocketIc, me:Principal, canister_id:Principal, subnet:Principal | undefined) {
     if (LEDGER_IMPL === "motoko") {
         // Motoko ledger upgrade with null args to keep existing state
@@ -213,19 +262,81 @@ function get_motoko_args(me: Principal): any {
     }
 }'''
 
-    if re.search(upgrade_pattern, content):
-        if 'LEDGER_IMPL === "motoko"' not in content or '"motoko"' not in content.split('ICRCLedgerUpgrade')[1].split('export')[0]:
-            content = re.sub(upgrade_pattern, new_upgrade, content)
-            patches_applied += 1
-            print("✓ Updated ICRCLedgerUpgrade function")
+    patches = [
+        Patch(
+            sentinel=SENTINELS['import'],
+            locate=_import_end,
+            replacement=motoko_import,
+            applied="Added Motoko import statement",
+            present="Motoko import already present",
+            missing="Could not find ICPLedgerService import pattern",
+        ),
+        Patch(
+            sentinel=SENTINELS['ledger_impl'],
+            locate=_ledger_type_end,
+            replacement=ledger_impl_code,
+            applied="Added LEDGER_IMPL export",
+            present="LEDGER_IMPL already present",
+            missing="Could not find LEDGER_TYPE export pattern",
+        ),
+        Patch(
+            sentinel=SENTINELS['wasm'],
+            locate=_wasm_block,
+            replacement=wasm_new,
+            applied="Updated WASM path section to use .wasm.gz",
+            present="MOTOKO_WASM_PATH already present",
+            missing="Could not find WASM path pattern",
+        ),
+        Patch(
+            sentinel=SENTINELS['get_motoko_args'],
+            locate=_get_args_end,
+            replacement=get_motoko_args_fn,
+            applied="Added get_motoko_args function",
+            present="get_motoko_args already present",
+            missing="Could not find get_args function pattern",
+        ),
+        Patch(
+            sentinel=SENTINELS['icrc_ledger'],
+            locate=_icrc_ledger_function,
+            replacement=new_icrc_ledger,
+            applied="Updated ICRCLedger function",
+            present="ICRCLedger already patched",
+            missing="Could not find ICRCLedger function pattern",
+            in_span=True,
+        ),
+        Patch(
+            sentinel=SENTINELS['upgrade'],
+            locate=_upgrade_function,
+            replacement=new_upgrade,
+            applied="Updated ICRCLedgerUpgrade function",
+            present="ICRCLedgerUpgrade already patched",
+            missing="Could not find ICRCLedgerUpgrade function pattern",
+            in_span=True,
+        ),
+    ]
+
+    # Edits are collected against the original content and spliced in once at the end
+    edits = []
+    for patch in patches:
+        if not patch.in_span and patch.sentinel in content:
+            print(f"○ {patch.present}")
+            continue
+        span = patch.locate(content)
+        if span is None:
+            print(f"✗ {patch.missing}")
+            continue
+        start, end = span
+        if patch.in_span and content.find(patch.sentinel, start, end) != -1:
+            print(f"○ {patch.present}")
         else:
-            print("○ ICRCLedgerUpgrade already patched")
-    else:
-        print("✗ Could not find ICRCLedgerUpgrade function pattern")
+            edits.append((start, end, patch.replacement))
+            print(f"✓ {patch.applied}")
+    patches_applied = len(edits)
 
     # Write the file
-    with open(COMMON_TS_PATH, 'w') as f:
-        f.write(content)
+    if edits:
+        content = _splice(content, edits)
+        Path(COMMON_TS_PATH).write_text(content, encoding='utf-8')
 
     print(f"\n{'='*50}")
     print(f"Applied {patches_applied} patch(es)")